@@ -1,35 +1,89 @@
 # Импорты
 import random
 import asyncio
-import base64
+import binascii
 import aiohttp
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 URL = "http://localhost:7860/sdapi/v1/"
 
-async def track_progress(session):
-    flag = False
+# одна сессия на цикл событий: пул соединений и keep-alive переиспользуются между генерациями.
+# В долгоживущем цикле (например, Jupyter) по окончании работы нужно вызвать close_session()
+_session = None
+_session_loop = None
+_session_closer = None  # цикл хранит задачи по слабой ссылке, держим свою
+
+async def _close_on_loop_shutdown(session):
+    # asyncio.run при завершении отменяет оставшиеся задачи и дожидается их,
+    # поэтому сессия закрывается в своем же цикле, вместе с соединениями
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await session.close()
+
+async def get_session():
+    global _session, _session_loop, _session_closer
+    loop = asyncio.get_running_loop()
+    # сессия привязана к циклу событий, при новом цикле (asyncio.run) создаем заново
+    if _session is None or _session.closed or _session_loop is not loop:
+        await close_session()
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=8, force_close=False))
+        _session_loop = loop
+        _session_closer = loop.create_task(_close_on_loop_shutdown(_session))
+    return _session
+
+async def close_session():
+    global _session, _session_loop, _session_closer
+    # задача-закрыватель больше не нужна; отменять ее можно только из ее же цикла
+    if _session_closer is not None and _session_loop is asyncio.get_running_loop():
+        _session_closer.cancel()
+    _session_closer = None
+    if _session is not None and not _session.closed:
+        try:
+            await _session.close()
+        except RuntimeError:
+            # цикл, к которому привязана сессия, уже закрыт: отсоединяем коннектор
+            _session.detach()
+    _session = None
+    _session_loop = None
+
+async def track_progress(session, stop_event):
+    delay = 0.25
+    last_percent = None
     while True:
-        await asyncio.sleep(0.5)
+        # ждем либо окончания генерации, либо следующего опроса
         try:
-            async with session.get(URL+"progress") as resp:
+            await asyncio.wait_for(stop_event.wait(), timeout=delay)
+            print("\nGeneration complete.")
+            break
+        except asyncio.TimeoutError:
+            pass
+        try:
+            async with session.get(URL+"progress", raise_for_status=False) as resp:
                 progress = await resp.json()
                 percent = progress.get("progress", 0) * 100
                 step = progress.get("state", {}).get("sampling_step", 0)
                 total = progress.get("state", {}).get("sampling_steps", '?')
 
                 print(f"Progress: {percent:.1f}% ({step}/{total})", end='\r')
-                if percent >= 100 or progress.get("state", {}).get("job_count", 0) == 0:
-                    if not flag:
-                        flag = True
-                        continue
-                    print("\nGeneration complete.")
-                    break
+                # пока прогресс не меняется, опрашиваем реже
+                if percent == last_percent:
+                    delay = min(2.0, max(0.25, delay * 1.5))
+                else:
+                    delay = 0.25
+                    last_percent = percent
         except Exception as e:
             print(f"Generation error: {e}")
             break
 
+async def post_txt2img(session, payload):
+    async with session.post(URL+"txt2img", json=payload) as response:
+        return await response.json()
+
 async def generate_image(prompt, negative_prompt, width = 896, height = 1440, steps = 40):
     payload = {
         "prompt": prompt,
@@ -40,25 +94,43 @@ async def generate_image(prompt, negative_prompt, width = 896, height = 1440, st
         "width": width,
         "height": height
     }
-    async with aiohttp.ClientSession() as session:
-        progress_task = asyncio.create_task(track_progress(session))
-        async with session.post(URL+"txt2img", json=payload) as response:
-            result = await response.json()
-        await progress_task
-        if "images" in result:
-            return result["images"]
-        else:
-            print("Error in image generation:", result)
-            return None
+    session = await get_session()
+    stop_event = asyncio.Event()
+    post_task = asyncio.create_task(post_txt2img(session, payload))
+    progress_task = asyncio.create_task(track_progress(session, stop_event))
+    # опрос прогресса завершается сразу, как только вернулся txt2img
+    try:
+        result = await post_task
+    except BaseException:
+        # txt2img не завершился: останавливаем опрос без сообщения о завершении
+        progress_task.cancel()
+        raise
+    stop_event.set()
+    await progress_task
+    if "images" in result:
+        return result["images"]
+    else:
+        print("Error in image generation:", result)
+        return None
+
+# папки, уже созданные в этом процессе
+_created_folders = set()
+# пул для декодирования и записи изображений вне цикла событий
+_io_pool = ThreadPoolExecutor(max_workers=4)
 
 def save_image(image, filename, folder=""):
     if folder:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+        if folder not in _created_folders:
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            _created_folders.add(folder)
         filename = os.path.join(folder, filename)
     if image is None:
         print("No image to save.")
         return
-    with open(filename + ".png", "wb") as f:
-        f.write(base64.b64decode(image))
+    # ответ API приходит без переносов строк, декодируем напрямую
+    Path(filename + ".png").write_bytes(binascii.a2b_base64(image))
+
+async def save_image_async(image, filename, folder=""):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_io_pool, save_image, image, filename, folder)
 
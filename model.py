@@ -3,6 +3,11 @@ from typing import List, Union, Set, Dict, Optional, Tuple
 from enum import Enum
 import math
 import json
+import sys
+try:
+    import orjson  # необязательная зависимость: в разы быстрее стандартного json
+except ImportError:
+    orjson = None
 
 class Gender(Enum):
     MALE = "male"
@@ -23,6 +28,11 @@ class Purpose(Enum):
     OTHER = "other"
 
 
+# поиск по сохраненному значению без Enum.__getitem__ и str.upper()
+_GENDER_MAP: Dict[str, Gender] = {g.value: g for g in Gender}
+_PURPOSE_MAP: Dict[str, Purpose] = {p.value: p for p in Purpose}
+
+
 class CombinePolicy(Enum):
     GEOMETRIC = "geometric"
     MULTIPLICATIVE = "multiplicative" # not realized yet
@@ -33,18 +43,20 @@ class PromptPart:
     """
     Атомарный элемент промпта: строка или вложенный PromptElement с весом.
     """
+    __slots__ = ("value", "weight")
+
     def __init__(self, value: Union[str, PromptElement], weight: float = 1.0):
         self.value = value
         self.weight = weight
 
-    def render(self) -> Dict[str, List[float]]:
+    def render(self, memo: Optional[dict] = None) -> Dict[str, List[float]]:
         """
         Преобразовать часть в строку для промпта с учетом веса.
         """
         if isinstance(self.value, str):
             return {self.value:[self.weight]}
         else:
-            return self.value.render(weight_override=self.weight)
+            return self.value.render(weight_override=self.weight, memo=memo)
 
     def collect_tags(self) -> Set[str]:
         """
@@ -60,6 +72,8 @@ class PromptElement:
     Базовый класс для тегов, персонажей и Lora: содержит имя, пол
     и упорядоченный список PromptPart.
     """
+    __slots__ = ("name", "gender", "parts", "combine_policy")
+
     def __init__(
         self,
         name: str,
@@ -72,21 +86,27 @@ class PromptElement:
         self.parts = parts
         self.combine_policy = combine_policy
 
-    def render(self, weight_override: float = 1.0) -> Dict[str, List[float]]:
+    def render(self, weight_override: float = 1.0, memo: Optional[dict] = None) -> Dict[str, List[float]]:
         """
         Сформировать словарь промптов с весами
         Если weight_override != 1.0, применить политику объединения.
+        memo - общий словарь на время одной сборки промпта: элемент,
+        вложенный в несколько тегов, рендерится только один раз.
         """
+        memo_key = (self, weight_override)
+        if memo is not None and memo_key in memo:
+            return {key: list(value) for key, value in memo[memo_key].items()}
+
         rendered_parts: Dict[str, List[float]] = {}
         for part in self.parts:
-            for key, value in part.render().items():
-                if key not in rendered_parts:
-                    rendered_parts[key] = []
-                rendered_parts[key].extend(value)
-        
+            for key, value in part.render(memo).items():
+                rendered_parts.setdefault(key, []).extend(value)
+
         for key in rendered_parts:
             rendered_parts[key].append(weight_override)
-        
+
+        if memo is not None:
+            memo[memo_key] = {key: tuple(value) for key, value in rendered_parts.items()}
         return rendered_parts
 
     def collect_all_tags(self) -> Set[str]:
@@ -104,6 +124,8 @@ class Tag(PromptElement):
     Тег промпта: цель, несовместимости
     и вложенные через PromptPart.
     """
+    __slots__ = ("purpose", "incompatible_names")
+
     def __init__(
         self,
         name: str,
@@ -116,14 +138,11 @@ class Tag(PromptElement):
         super().__init__(name, gender, parts, combine_policy)
         self.purpose = purpose
         self.incompatible_names: Set[str] = incompatible_names or set()
-        self.incompatible_tags: Set[Tag] = set()
 
     def add_incompatibility(self, other: Tag):
         """
         Установить взаимную несовместимость с другим тегом.
         """
-        self.incompatible_tags.add(other)
-        other.incompatible_tags.add(self)
         self.incompatible_names.add(other.name)
         other.incompatible_names.add(self.name)
 
@@ -138,6 +157,8 @@ class Character(PromptElement):
     """
     Персонаж: хранит имя, пол, части промпта и счетчик использования.
     """
+    __slots__ = ("images_generated",)
+
     def __init__(
         self,
         name: str,
@@ -158,6 +179,8 @@ class Lora(PromptElement):
     """
     Класс для Lora-моделей: выводит в формате <lora:имя:вес>.
     """
+    __slots__ = ("weight",)
+
     def __init__(
         self,
         name: str,
@@ -166,7 +189,7 @@ class Lora(PromptElement):
         super().__init__(name, Gender.UNISEX, [], combine_policy=CombinePolicy.MULTIPLICATIVE)
         self.weight = weight
 
-    def render(self, weight_override: float = 1.0) -> Dict[str, List[float]]:
+    def render(self, weight_override: float = 1.0, memo: Optional[dict] = None) -> Dict[str, List[float]]:
         """
         Render для Lora: применяет собственный вес и внешний override.
         """
@@ -179,6 +202,16 @@ class PromptFactory:
     Возвращает (prompt_str, filename) с кодом usage.
     Можно опционально проверять соответствие пола тегов и персонажей.
     """
+    @staticmethod
+    def _geometric_mean(weights: List[float]) -> float:
+        """
+        Среднее геометрическое через сумму логарифмов: без переполнения
+        произведения при большом числе весов.
+        """
+        if 0 in weights:
+            return 0.0
+        return math.exp(math.fsum(map(math.log, weights)) / len(weights))
+
     @staticmethod
     def generate(
         elements: List[PromptElement | None],
@@ -211,44 +244,44 @@ class PromptFactory:
             raise ValueError("Необходимо указать хотя бы одного персонажа")
         group_strs: List[str] = []
         name_parts: List[str] = []
+        # результаты render() вложенных элементов переиспользуются в пределах одного промпта
+        memo: dict = {}
         for char, parts in groups:
             name_parts.append(f"{char.name}_{char.images_generated}")
             # проверка несовместимости только для Tag
+            # пересекаем несовместимости каждого тега с именами группы за один проход;
+            # пару ищем только для тега, у которого пересечение непустое
             tags = [p for p in parts if isinstance(p, Tag)]
-            for t1 in tags:
-                for t2 in tags:
-                    if t1 is not t2 and not t1.is_compatible_with(t2):
-                        raise ValueError(f"Теги '{t1.name}' и '{t2.name}' несовместимы")
-            rend = char.render()
+            names = {t.name for t in tags}
+            for tag in tags:
+                if tag.incompatible_names.isdisjoint(names):
+                    continue
+                for other in tags:
+                    if other is not tag and other.name in tag.incompatible_names:
+                        raise ValueError(f"Теги '{tag.name}' и '{other.name}' несовместимы")
+            rend = char.render(memo=memo)
             for part in parts:
-                if isinstance(part, Tag):
-                    for key, value in part.render().items():
-                        if key not in rend:
-                            rend[key] = []
-                        rend[key].extend(value)
-                elif isinstance(part, Lora):
-                    for key, value in part.render().items():
-                        if key not in rend:
-                            rend[key] = []
-                        rend[key].extend(value)
+                if isinstance(part, (Tag, Lora)):
+                    for key, value in part.render(memo=memo).items():
+                        rend.setdefault(key, []).extend(value)
                 else:
                     raise TypeError(f"Неподдерживаемый тип: {type(part)}")
             # применение политики объединения
             if char.combine_policy == CombinePolicy.GEOMETRIC:
-                for key in rend:
-                    rend[key] = [math.prod(rend[key]) ** (1 / len(rend[key]))]
+                for key, weights in rend.items():
+                    if weights:
+                        rend[key] = [PromptFactory._geometric_mean(weights)]
 
-            group_str = ""
+            pieces: List[str] = []
             for key, value in rend.items():
-                if "<lora:" in key:
-                    group_str += f"{key}, "
+                if key.startswith("<lora:"):
+                    pieces.append(key)
+                elif value[0] == 1:
+                    pieces.append(key)
                 else:
-                    if value[0] == 1:
-                        group_str += f"{key}, "
-                    else:
-                        group_str += f"({key}:{value[0]}), "
-            group_strs.append(group_str)
-        prompt_str = f" {break_token}, ".join(group_strs)
+                    pieces.append(f"({key}:{value[0]})")
+            group_strs.append(", ".join(pieces))
+        prompt_str = f", {break_token}, ".join(group_strs)
         filename = "_".join(name_parts)
         return prompt_str, filename
 
@@ -260,22 +293,29 @@ class TagRegistry:
     _tags: Dict[str, Tag] = {}
     _chars: Dict[str, Character] = {}
     _loras: Dict[str, Lora] = {}
+    # общий индекс для find; при совпадении имен приоритет: тег, персонаж, Lora
+    _all: Dict[str, PromptElement] = {}
 
     @classmethod
     def register_tag(cls, tag: Tag):
         cls._tags[tag.name] = tag
+        cls._all[tag.name] = tag
 
     @classmethod
     def register_char(cls, char: Character):
         cls._chars[char.name] = char
+        if char.name not in cls._tags:
+            cls._all[char.name] = char
 
     @classmethod
     def register_lora(cls, lora: Lora):
         cls._loras[lora.name] = lora
+        if lora.name not in cls._tags and lora.name not in cls._chars:
+            cls._all[lora.name] = lora
 
     @classmethod
     def find(cls, name: str) -> Optional[PromptElement]:
-        return cls._tags.get(name) or cls._chars.get(name) or cls._loras.get(name)
+        return cls._all.get(name)
 
     @classmethod
     def all_tags(cls) -> List[Tag]:
@@ -289,114 +329,122 @@ class TagRegistry:
     def all_loras(cls) -> List[Lora]:
         return list(cls._loras.values())
 
+    @staticmethod
+    def _dump_json(obj) -> bytes:
+        """
+        Сериализовать объект в JSON с отступом 2 (orjson, если установлен).
+        """
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+    @staticmethod
+    def _parts_data(parts: List[PromptPart]) -> List[dict]:
+        return [{'type': 'string' if isinstance(part.value, str) else 'element',
+                 'value': part.value if isinstance(part.value, str) else part.value.name,
+                 'weight': part.weight}
+                for part in parts]
+
     @classmethod
     def save(cls, filepath: str):
         """
         Сохранить персонажей, теги и Lora в JSON-файл.
+        Элементы сериализуются и записываются по одному, поэтому
+        весь реестр целиком в памяти не собирается.
         """
-        data = {
-            'characters': [
+        sections = {
+            'characters': (
                 {'name': c.name, 'gender': c.gender.value,
-                 'parts': [{'type': 'string' if isinstance(part.value, str) else 'element',
-                            'value': part.value if isinstance(part.value, str) else part.value.name,
-                            'weight': part.weight}
-                           for part in c.parts],
-                 'images_generated': c.images_generated
-                }
+                 'parts': cls._parts_data(c.parts),
+                 'images_generated': c.images_generated}
                 for c in cls.all_characters()
-            ],
-            'tags': [
+            ),
+            'tags': (
                 {'name': t.name, 'gender': t.gender.value, 'purpose': t.purpose.value,
-                 'parts': [{'type': 'string' if isinstance(part.value, str) else 'element',
-                            'value': part.value if isinstance(part.value, str) else part.value.name,
-                            'weight': part.weight}
-                           for part in t.parts],
-                 'incompatibles': list(t.incompatible_names)
-                }
+                 'parts': cls._parts_data(t.parts),
+                 'incompatibles': list(t.incompatible_names)}
                 for t in cls.all_tags()
-            ],
-            'loras': [
+            ),
+            'loras': (
                 {'name': lora.name, 'weight': lora.weight}
                 for lora in cls.all_loras()
-            ]
+            ),
         }
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(filepath, 'wb') as f:
+            f.write(b'{')
+            for i, (key, entries) in enumerate(sections.items()):
+                f.write(b',\n  ' if i else b'\n  ')
+                f.write(cls._dump_json(key) + b': [')
+                empty = True
+                for entry in entries:
+                    f.write(b'\n    ' if empty else b',\n    ')
+                    # внутри строк JSON переводов строки нет, поэтому сдвигаем весь элемент
+                    f.write(cls._dump_json(entry).replace(b'\n', b'\n    '))
+                    empty = False
+                f.write(b']' if empty else b'\n  ]')
+            f.write(b'\n}')
+
+    @classmethod
+    def _load_parts(cls, parts_data: List[dict]) -> List[PromptPart]:
+        """
+        Восстановить части промпта из JSON, подставив зарегистрированные элементы.
+        """
+        parts: List[PromptPart] = []
+        for part_data in parts_data:
+            if part_data['type'] == 'string':
+                # одинаковые строки частей у разных элементов хранятся один раз
+                value = sys.intern(part_data['value'])
+            else:
+                try:
+                    value = cls._all[part_data['value']]
+                except KeyError:
+                    raise ValueError(f"Неизвестный элемент: {part_data['value']}") from None
+            parts.append(PromptPart(value, part_data['weight']))
+        return parts
 
     @classmethod
     def load(cls, filepath: str):
         """
         Загрузить персонажей, теги и Lora из JSON-файла.
         """
-        with open(filepath, 'r', encoding='utf-8') as f:
-            # Чтение основной информации без вложенных тегов
-            # и создание объектов Tag, Character и Lora
-            data = json.load(f)
-            for char_data in data.get('characters', []):
-                char = Character(
-                    name=char_data['name'],
-                    gender=Gender[char_data['gender'].upper()],
-                    parts=[])
-                TagRegistry.register_char(char)
-            for tag_data in data.get('tags', []):
-                tag = Tag(
-                    name=tag_data['name'],
-                    gender=Gender[tag_data['gender'].upper()],
-                    purpose=Purpose[tag_data['purpose'].upper()],
-                    parts=[])
-                TagRegistry.register_tag(tag)
-            for lora_data in data.get('loras', []):
-                lora = Lora(
-                    name=lora_data['name'],
-                    weight=lora_data['weight'])
-                TagRegistry.register_lora(lora)
-            
-            # Чтение вложенных тегов и частей
-            # и добавление их в соответствующие объекты Tag и Character
-            for char_data in data.get('characters', []):
-                char = TagRegistry.find(char_data['name'])
-                if char is None:
-                    char = Character(
-                        name=char_data['name'],
-                        gender=Gender[char_data['gender'].upper()],
-                        parts=[]
-                    )
-                    TagRegistry.register_char(char)
-                for part_data in char_data['parts']:
-                    if part_data['type'] == 'string':
-                        char.parts.append(PromptPart(part_data['value'], part_data['weight']))
-                    else:
-                        insertion = TagRegistry.find(part_data['value'])
-                        if insertion is None:
-                            raise ValueError(f"Неизвестный элемент: {part_data['value']}")
-                        part = PromptPart(insertion, part_data['weight'])
-                        char.parts.append(part)
-                if isinstance(char, Character):
-                    char.images_generated = char_data['images_generated']
-            for tag_data in data.get('tags', []):
-                tag = TagRegistry.find(tag_data['name'])
-                if tag is None:
-                    tag = Tag(
-                        name=tag_data['name'],
-                        gender=Gender[tag_data['gender'].upper()],
-                        purpose=Purpose[tag_data['purpose'].upper()],
-                        parts=[]
-                    )
-                    TagRegistry.register_tag(tag)
-                for part_data in tag_data['parts']:
-                    if part_data['type'] == 'string':
-                        tag.parts.append(PromptPart(part_data['value'], part_data['weight']))
-                    else:
-                        insertion = TagRegistry.find(part_data['value'])
-                        if insertion is None:
-                            raise ValueError(f"Неизвестный элемент: {part_data['value']}")
-                        part = PromptPart(insertion, part_data['weight'])
-                        tag.parts.append(part)
-                for name in tag_data['incompatibles']:
-                    incompatible_tag = TagRegistry.find(name)
-                    if incompatible_tag is None:
-                        raise ValueError(f"Неизвестный элемент: {name}")
-                    if isinstance(tag, Tag) and isinstance(incompatible_tag, Tag):
-                        tag.add_incompatibility(incompatible_tag)
-                
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        # Чтение основной информации без вложенных тегов
+        # и создание объектов Tag, Character и Lora
+        for char_data in data.get('characters', []):
+            char = Character(
+                name=char_data['name'],
+                gender=_GENDER_MAP.get(char_data['gender']) or Gender[char_data['gender'].upper()],
+                parts=[])
+            TagRegistry.register_char(char)
+        for tag_data in data.get('tags', []):
+            tag = Tag(
+                name=tag_data['name'],
+                gender=_GENDER_MAP.get(tag_data['gender']) or Gender[tag_data['gender'].upper()],
+                purpose=_PURPOSE_MAP.get(tag_data['purpose']) or Purpose[tag_data['purpose'].upper()],
+                parts=[])
+            TagRegistry.register_tag(tag)
+        for lora_data in data.get('loras', []):
+            lora = Lora(
+                name=lora_data['name'],
+                weight=lora_data['weight'])
+            TagRegistry.register_lora(lora)
+        
+        # Чтение вложенных тегов и частей
+        # и добавление их в уже созданные объекты Tag и Character
+        for char_data in data.get('characters', []):
+            char = cls._chars[char_data['name']]
+            char.parts.extend(cls._load_parts(char_data['parts']))
+            char.images_generated = char_data['images_generated']
+        for tag_data in data.get('tags', []):
+            tag = cls._tags[tag_data['name']]
+            tag.parts.extend(cls._load_parts(tag_data['parts']))
+            for name in tag_data['incompatibles']:
+                incompatible_tag = cls._all.get(name)
+                if incompatible_tag is None:
+                    raise ValueError(f"Неизвестный элемент: {name}")
+                if isinstance(incompatible_tag, Tag):
+                    tag.add_incompatibility(incompatible_tag)
             
+        
@@ -1,6 +1,8 @@
 import gradio as gr
 import os
-import shutil
+import struct
+import zlib
+from functools import lru_cache
 from PIL import Image
 from PIL.ExifTags import TAGS
 from tkinter import Tk, filedialog
@@ -10,6 +12,8 @@ image_list = []
 current_index = 0
 input_folder = ""
 out_folder = {}
+image_exts = {".png", ".jpg", ".jpeg", ".webp"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
 # === Функции ===
 def prepare_folders(folder):
@@ -23,27 +27,78 @@ def prepare_folders(folder):
         os.makedirs(path, exist_ok=True)
 
 
-def get_metadata(image_path):
+def read_png_text(image_path):
+    """
+    Прочитать текстовые чанки PNG (tEXt, zTXt, iTXt) без PIL.
+    Возвращает None, если файл не PNG.
+    """
+    text = {}
+    with open(image_path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            # метаданные SD записываются до данных изображения, дальше читать не нужно
+            if chunk_type in (b"IDAT", b"IEND"):
+                break
+            if chunk_type not in (b"tEXt", b"zTXt", b"iTXt"):
+                f.seek(length + 4, os.SEEK_CUR)  # данные и CRC
+                continue
+            data = f.read(length)
+            f.seek(4, os.SEEK_CUR)  # CRC
+            key, _, value = data.partition(b"\0")
+            if chunk_type == b"tEXt":
+                value = value.decode("latin-1")
+            elif chunk_type == b"zTXt":
+                value = zlib.decompress(value[1:]).decode("latin-1")
+            else:
+                compressed = value[0]
+                _lang, _, rest = value[2:].partition(b"\0")
+                _translated_key, _, value = rest.partition(b"\0")
+                if compressed:
+                    value = zlib.decompress(value)
+                value = value.decode("utf-8", errors="replace")
+            text[key.decode("latin-1")] = value
+    return text
+
+
+@lru_cache(maxsize=256)
+def read_metadata(image_path, mtime, size):
+    # mtime и size входят в ключ кэша, чтобы измененный файл перечитывался
     try:
-        image = Image.open(image_path)
-        info = image.info
-        exif_data = image.getexif()
-        metadata = ""
-        for tag_id, value in exif_data.items():
-            tag = TAGS.get(tag_id, tag_id)
-            metadata += f"{tag}: {value}\n"
-        for k, v in info.items():
-            metadata += f"{k}: {v}\n"
+        # PNG от Stable Diffusion хранят параметры в текстовых чанках, для них PIL не нужен
+        if image_path.lower().endswith(".png"):
+            text = read_png_text(image_path)
+            if text is not None:
+                metadata = "".join(f"{k}: {v}\n" for k, v in text.items())
+                return metadata.strip() or "Нет доступных метаданных"
+        with Image.open(image_path) as image:
+            metadata = ""
+            for tag_id, value in image.getexif().items():
+                tag = TAGS.get(tag_id, tag_id)
+                metadata += f"{tag}: {value}\n"
+            for k, v in image.info.items():
+                metadata += f"{k}: {v}\n"
         return metadata.strip() or "Нет доступных метаданных"
     except Exception as e:
         return f"Ошибка чтения метаданных: {e}"
 
 
+def get_metadata(image_path):
+    try:
+        st = os.stat(image_path)
+    except OSError as e:
+        return f"Ошибка чтения метаданных: {e}"
+    return read_metadata(image_path, st.st_mtime_ns, st.st_size)
+
+
 def load_image():
-    global current_index, image_list, input_folder
+    global current_index, image_list
     if current_index < len(image_list):
-        filename = image_list[current_index]
-        full_path = os.path.join(input_folder, filename)
+        full_path = image_list[current_index]
         metadata = get_metadata(full_path)
         progress = f"Изображение {current_index + 1} из {len(image_list)}"
         return full_path, metadata, progress
@@ -52,17 +107,17 @@ def load_image():
 
 
 def classify_image(action):
-    global current_index, image_list, input_folder
+    global current_index, image_list
     if current_index >= len(image_list):
         return None, "Изображения закончились!", "Готово!"
 
-    filename = image_list[current_index]
-    src = os.path.join(input_folder, filename)
-    dest = os.path.join(out_folder[action], filename)
+    src = image_list[current_index]
+    dest = os.path.join(out_folder[action], os.path.basename(src))
 
+    # папки назначения вложены в исходную, поэтому перемещение всегда в пределах одного диска
     try:
-        shutil.move(src, dest)
-    except Exception as e:
+        os.replace(src, dest)
+    except OSError as e:
         return None, f"Ошибка перемещения: {e}", "Ошибка!"
 
     current_index += 1
@@ -77,8 +132,13 @@ def select_folder_gui():
 
 def select_folder(folder):
     global input_folder, image_list, current_index
-    input_folder = folder
-    image_list = [f for f in os.listdir(input_folder) if f.lower().endswith(('png', 'jpg', 'jpeg', 'webp'))]
+    # путь разрешается один раз: пути в image_list и out_folder сразу абсолютные
+    input_folder = os.path.abspath(folder)
+    # храним полные пути, чтобы не собирать их заново при каждом показе
+    with os.scandir(input_folder) as entries:
+        image_list = [e.path for e in entries
+                      if e.is_file(follow_symlinks=False)
+                      and os.path.splitext(e.name)[1].lower() in image_exts]
     current_index = 0
     prepare_folders(input_folder)
     return load_image()
@@ -113,12 +173,15 @@ function toggleFullscreen() {
   }
 }
 
-setTimeout(() => {
- let img = document.querySelector('#image_preview img');
- if (img) {
-   img.addEventListener('click', toggleFullscreen);
- }
-}, 2000);
+// вешаем обработчик, как только Gradio добавит (или заменит) картинку
+const fullscreenObserver = new MutationObserver(() => {
+  let img = document.querySelector('#image_preview img');
+  if (img && !img.__fsWired) {
+    img.addEventListener('click', toggleFullscreen);
+    img.__fsWired = true;
+  }
+});
+fullscreenObserver.observe(document.documentElement, {subtree: true, childList: true});
 </script>
 """
 